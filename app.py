@@ -1,23 +1,43 @@
+import asyncio
+import hashlib
+import itertools
+import json
 import logging
 import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from collections.abc import Iterable
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from pathlib import Path
 from typing import Literal
 
 import dotenv
-import duckdb
 import geopandas as gpd
 import geoviews as gv
 import geoviews.tile_sources as gvts
 import holoviews as hv
+import numpy as np
 import panel as pn
 import param
 import pyproj
-import pystac_client
-import shapely.geometry
+import shapely
 from holoviews import streams
 from shapely import wkt
-from shapely.geometry import Point
-from shapely.wkb import loads
-from utils import create_offset_rectangle
+from shapely.geometry import LineString, Point
+from shapely.geometry.base import BaseGeometry
+from utils import (
+    create_offset_rectangle,
+    get_duckdb_connection,
+    get_etag,
+    get_transformer,
+    load_duckdb_extension,
+    open_stac_client,
+    read_stac_items,
+    transform_geometry,
+)
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.DEBUG)
@@ -26,11 +46,76 @@ sas_token = os.getenv("APPSETTING_GCTS_AZURE_STORAGE_SAS_TOKEN")
 
 
 class SpatialQueryEngine:
+    CACHE_DIR = Path.home() / ".cache" / "coastapp"
+    STAC_PAGE_SIZE = 500
+    # Seconds before a tile whose table failed to build is tried again
+    TILE_RETRY_AFTER = 60 * 60
+
+    # NOTE: candidates are ranked on the (cheap) planar distance between their bbox
+    # center and the point, so no geometry is reprojected inside DuckDB. The exact
+    # nearest transect is then picked from these few candidates in Python. The envelope
+    # is formatted into the query because DuckDB only substitutes an RTree index scan
+    # for ST_Intersects with a constant envelope; the other values are bound.
+    NEAREST_QUERY = """
+    SELECT
+        tr_name,
+        utm_crs,
+        bbox,
+        ST_AsWKB(geometry) AS geometry
+    FROM
+        {table}
+    WHERE
+        ST_Intersects(geometry, ST_MakeEnvelope({minx!r}, {miny!r}, {maxx!r}, {maxy!r}))
+    ORDER BY
+        power((bbox.xmin + bbox.xmax) / 2 - $x, 2) +
+        power((bbox.ymin + bbox.ymax) / 2 - $y, 2)
+    LIMIT $num_candidates;
+    """
+
+    # NOTE: a click in a tile that isn't cached yet reads only the row groups whose bbox
+    # statistics overlap the search window. Partitions written by rewrite_partition
+    # have flat bbox_* columns for this, others fall back to the nested bbox struct.
+    REMOTE_NEAREST_QUERY = """
+    SELECT
+        tr_name,
+        utm_crs,
+        bbox,
+        geometry
+    FROM
+        read_parquet($href)
+    WHERE
+        {xmin} <= $maxx AND {ymin} <= $maxy AND {xmax} >= $minx AND {ymax} >= $miny
+    ORDER BY
+        power(({xmin} + {xmax}) / 2 - $x, 2) +
+        power(({ymin} + {ymax}) / 2 - $y, 2)
+    LIMIT $num_candidates;
+    """
+
+    # NOTE: after the first click, a quadtile is read into an in-memory table with an
+    # RTree index on the geometry in the background, so later clicks in the same tile
+    # don't go back to the remote parquet.
+    TILE_TABLE_QUERY = """
+    CREATE TABLE {table} AS
+    SELECT
+        tr_name,
+        utm_crs,
+        bbox,
+        ST_GeomFromWKB(geometry) AS geometry
+    FROM
+        read_parquet($href);
+    """
+
     def __init__(
         self,
         stac_url: str,
         collection_id: str,
         storage_backend: Literal["azure", "aws"] = "azure",
+        threads: int | None = None,
+        memory_limit: str | None = None,
+        bbox: tuple[float, float, float, float] | None = None,
+        cache_size: int = 1024,
+        max_cached_tiles: int = 8,
+        quadtile_cache_ttl: float = 24 * 60 * 60,
     ):
         """
         Initializes the SpatialQueryEngine with STAC collection details.
@@ -39,25 +124,88 @@ class SpatialQueryEngine:
             stac_url: URL to the STAC catalog.
             collection_id: ID of the collection within the STAC catalog.
             storage_backend: Specifies the storage backend to use. Defaults to 'azure'.
+            threads: Number of DuckDB worker threads. Defaults to the number of CPUs.
+                Like memory_limit, this is set on the DuckDB connection that all
+                engines with the same storage backend share, so it's process-wide.
+            memory_limit: DuckDB memory limit, e.g. '2GB', for the shared connection.
+                Defaults to DuckDB's own limit (80% of the system memory).
+            bbox: Optional (minx, miny, maxx, maxy) area of interest in EPSG:4326 that
+                limits which quadtiles are loaded. Defaults to the whole collection.
+            cache_size: Maximum number of nearest-transect results kept in memory.
+            max_cached_tiles: Maximum number of quadtiles kept as indexed tables.
+            quadtile_cache_ttl: Maximum age in seconds of the local quadtile cache. It's
+                refreshed earlier when the ETag of the catalog changes. Defaults to a
+                day.
         """
         self.storage_backend = storage_backend
-        self.con = duckdb.connect(database=":memory:", read_only=False)
-        self.con.execute("INSTALL spatial;")
-        self.con.execute("LOAD spatial;")
+        self.threads = threads or os.cpu_count() or 1
+        self.memory_limit = memory_limit
+        self.cache_size = cache_size
+        self.max_cached_tiles = max_cached_tiles
+        self.quadtile_cache_ttl = quadtile_cache_ttl
+        self._nearest_cache = OrderedDict()
+        self._tile_tables = OrderedDict()
+        # NOTE: engines with the same storage backend share a connection, so prefix the
+        # tile tables to keep engines from replacing or dropping each other's tables.
+        self._tile_prefix = uuid.uuid4().hex[:8]
+        self._tile_ids = itertools.count()
+        # Reference counts of the tile tables, the tiles that are being built and the
+        # retry times of the tiles that failed to build
+        self._tile_refs = {}
+        self._tile_builds = set()
+        self._tile_failures = {}
+        self._tile_executor = ThreadPoolExecutor(max_workers=1)
+        self._bbox_columns = {}
+        # NOTE: queries run on their own cursor, so these locks only guard the caches
+        # and the tile registry when called from worker threads.
+        self._lock = threading.Lock()
+        self._tile_lock = threading.Lock()
+        self.con = get_duckdb_connection(storage_backend)
+        load_duckdb_extension(self.con, "spatial")
+        # NOTE: keep geometry columns as WKB blobs when reading GeoParquet, so the
+        # remote query returns bytes and the tile tables parse them with ST_GeomFromWKB.
+        self.con.execute("SET enable_geoparquet_conversion = false;")
         self.configure_storage_backend()
 
-        # Directly load quadtiles from the STAC collection
-        self.quadtiles = self.load_quadtiles_from_stac(stac_url, collection_id)
-        if len(self.quadtiles["proj:epsg"].unique()) > 1:
+        # Directly load quadtiles from the STAC collection, but only keep the columns
+        # that are needed for the point lookups as plain arrays.
+        quadtiles = self.load_quadtiles(stac_url, collection_id, bbox)
+        if len(quadtiles["proj:epsg"].unique()) > 1:
             raise ValueError("Multiple CRSs found in the STAC collection.")
-        self.proj_epsg = self.quadtiles["proj:epsg"].unique().item()
+        self.proj_epsg = quadtiles["proj:epsg"].unique().item()
+        self._quadtile_hrefs = self.resolve_access_hrefs(quadtiles["href"])
+        self._quadtile_geoms = quadtiles.geometry.to_numpy()
+        shapely.prepare(self._quadtile_geoms)
+
+        # NOTE: quadtiles are axis-aligned rectangles, so a point lookup only has to
+        # compare against their bounds, stored as one contiguous (4, n) array.
+        self._quadtile_bounds = np.ascontiguousarray(
+            shapely.bounds(self._quadtile_geoms).T
+        )
+        # Transformer that is reused for every point query
+        self._to_proj = get_transformer(4326, self.proj_epsg)
 
         self.radius = 10000.0  # Max radius for nearest search
+        self.num_candidates = 16  # Candidates to compute the exact distance for
 
     def configure_storage_backend(self):
+        # Cached results were read through the previous backend configuration
+        self._nearest_cache.clear()
+        self.drop_tile_tables()
+
+        # NOTE: DuckDB also uses its threads to fetch row groups of remote parquet
+        # concurrently, so don't leave this to a conservative default.
+        self.con.execute(f"SET threads = {self.threads};")
+        if self.memory_limit is not None:
+            # NOTE: the cached tile tables count towards this limit as well
+            self.con.execute(f"SET memory_limit = '{self.memory_limit}';")
+
         if self.storage_backend == "azure":
-            self.con.execute("INSTALL azure;")
-            self.con.execute("LOAD azure;")
+            load_duckdb_extension(self.con, "azure")
+            # NOTE: hrefs are currently rewritten to https URLs with a SAS token (see
+            # resolve_access_hrefs), so the actual reads go through httpfs and the
+            # azure_* transfer settings don't apply until reads use azure:// again.
+            load_duckdb_extension(self.con, "httpfs")
 
             # # NOTE: currently this is commented because settings the credentials doesn't work
             # if duckdb.__version__ > "0.10.0":
@@ -78,8 +226,7 @@ class SpatialQueryEngine:
             #     )
 
         elif self.storage_backend == "aws":
-            self.con.execute("INSTALL httpfs;")
-            self.con.execute("LOAD httpfs;")
+            load_duckdb_extension(self.con, "httpfs")
             self.con.execute("SET s3_region = 'eu-west-2';")
             self.con.execute(
                 f"SET s3_access_key_id = '{os.getenv('AWS_ACCESS_KEY_ID')}';"
@@ -88,75 +235,293 @@ class SpatialQueryEngine:
                 f"SET s3_secret_access_key = '{os.getenv('AWS_SECRET_ACCESS_KEY')}';"
             )
 
+        # Keep parquet footers, remote file metadata and the read byte ranges around
+        # between clicks
+        self.con.execute("SET enable_object_cache = true;")
+        self.con.execute("SET enable_http_metadata_cache = true;")
+        self.con.execute("SET enable_external_file_cache = true;")
+
+    def load_quadtiles(
+        self,
+        stac_url: str,
+        collection_id: str,
+        bbox: tuple[float, float, float, float] | None = None,
+    ) -> gpd.GeoDataFrame:
+        """Loads the quadtiles from the local cache, or from STAC when it's outdated."""
+        key = json.dumps([stac_url, collection_id, bbox])
+        digest = hashlib.sha1(key.encode()).hexdigest()
+        cache_path = self.CACHE_DIR / f"quadtiles_{digest}.parquet"
+        etag_path = cache_path.with_suffix(".etag")
+
+        # NOTE: the ETag of the root catalog only changes when that document changes,
+        # not when items of a static catalog are added or replaced. So the age of the
+        # cache is always an upper bound, and a changed ETag invalidates it earlier.
+        etag = get_etag(stac_url)
+        if cache_path.exists():
+            is_valid = (
+                time.time() - cache_path.stat().st_mtime < self.quadtile_cache_ttl
+            )
+            if etag is not None:
+                is_valid &= etag_path.exists() and etag_path.read_text() == etag
+            if is_valid:
+                return gpd.read_parquet(cache_path)
+
+        quadtiles = self.load_quadtiles_from_stac(stac_url, collection_id, bbox)
+        try:
+            self.CACHE_DIR.mkdir(parents=True, exist_ok=True)
+            # Write to a temporary file first, so other processes never read a partial
+            # cache file
+            tmp_path = cache_path.with_suffix(f".{os.getpid()}.tmp")
+            quadtiles.to_parquet(tmp_path)
+            tmp_path.replace(cache_path)
+            if etag is not None:
+                etag_path.write_text(etag)
+            else:
+                etag_path.unlink(missing_ok=True)
+        except OSError as e:
+            logger.warning(f"Could not cache the quadtiles due to {e}.")
+        return quadtiles
+
     def load_quadtiles_from_stac(
-        self, stac_url: str, collection_id: str
+        self,
+        stac_url: str,
+        collection_id: str,
+        bbox: tuple[float, float, float, float] | None = None,
     ) -> gpd.GeoDataFrame:
         """Fetches and processes a STAC collection to create a GeoDataFrame of quadtiles."""
-        stac_client = pystac_client.Client.open(stac_url)
-        collection = stac_client.get_child(collection_id)
-        items = collection.get_all_items()
-        quadtiles = gpd.GeoDataFrame(
-            [self.extract_storage_partition(item) for item in items], crs="EPSG:4326"
-        )
+        # NOTE: imported here because the client is only needed to (re)build the index
+        from pystac_client.conformance import ConformanceClasses
+
+        stac_client = open_stac_client(stac_url)
+        if stac_client.conforms_to(ConformanceClasses.ITEM_SEARCH):
+            # Let the API filter the items and skip hydrating them into pystac objects.
+            # NOTE: larger pages mean fewer round trips than the API's default (often 10)
+            items = stac_client.search(
+                collections=[collection_id], bbox=bbox, limit=self.STAC_PAGE_SIZE
+            ).items_as_dicts()
+        else:
+            # Static catalogs can only be walked, so fetch the items (incl. those in
+            # sub-catalogs) concurrently and filter them client side
+            collection = stac_client.get_child(collection_id)
+            items = read_stac_items(collection.get_self_href())
+            if bbox is not None:
+                aoi = shapely.box(*bbox)
+                items = (i for i in items if aoi.intersects(shapely.box(*i["bbox"])))
+
+        quadtiles = self.extract_storage_partitions(items)
         return quadtiles
 
     @staticmethod
-    def extract_storage_partition(stac_item) -> dict:
-        """Extracts geometry and href from a STAC item."""
-        return {
-            "geometry": shapely.geometry.shape(stac_item.geometry),
-            "href": stac_item.assets["data"].href,
-            "proj:epsg": stac_item.properties["proj:epsg"],
-        }
-
-    def get_nearest_geometry(self, x, y):
-        point = Point(x, y)
-        point_gdf = gpd.GeoDataFrame(geometry=[point], crs="EPSG:4326")
-        href = gpd.sjoin(self.quadtiles, point_gdf, predicate="contains").href.iloc[0]
-        point_wkt = point_gdf.to_crs(self.proj_epsg).geometry.to_wkt().iloc[0]
+    def extract_storage_partitions(stac_items: Iterable[dict]) -> gpd.GeoDataFrame:
+        """Extracts geometries, hrefs and EPSG codes from STAC item dictionaries."""
+        geometries, hrefs, epsgs = [], [], []
+        for stac_item in stac_items:
+            geometries.append(json.dumps(stac_item["geometry"]))
+            hrefs.append(stac_item["assets"]["data"]["href"])
+            epsgs.append(stac_item["properties"]["proj:epsg"])
+
+        # Build the frame from columns and parse all geometries in one vectorized call
+        return gpd.GeoDataFrame(
+            {"href": hrefs, "proj:epsg": epsgs},
+            geometry=shapely.from_geojson(geometries),
+            crs="EPSG:4326",
+        )
+
+    def resolve_access_hrefs(self, hrefs):
+        """Maps the quadtile hrefs to the URLs that DuckDB reads the data from."""
         # NOTE: for DuckDB queries a small hack that replaces az:// with azure://
         if self.storage_backend == "azure":
             # NOTE: leave this here because that's required for duckdb, when we manage to
             # set the azure credentials credentials in the DuckDB connection.
-            # href = href.replace("az://", "azure://")
-            href = href.replace("az://", "https://coclico.blob.core.windows.net/")
-            href = href + "?" + sas_token
-
-        minx, miny, maxx, maxy = (
-            gpd.GeoDataFrame(
-                point_gdf.to_crs(3857).buffer(10000).to_frame("geometry"),
-                crs=3857,
+            # hrefs = hrefs.str.replace("az://", "azure://", regex=False)
+            hrefs = hrefs.str.replace(
+                "az://", "https://coclico.blob.core.windows.net/", regex=False
             )
-            .to_crs(4326)
-            .total_bounds
-        )
+            if sas_token:
+                hrefs = hrefs + "?" + sas_token
+        return hrefs.to_numpy()
 
-        minx, miny, maxx, maxy = point_gdf.total_bounds
-
-        query = f"""
-        SELECT 
-            tr_name, 
-            bbox, 
-            ST_AsWKB(ST_Transform(ST_GeomFromWKB(geometry), 'EPSG:4326', 'EPSG:4326')) AS geometry, 
-            ST_Distance(
-                ST_Transform(ST_GeomFromWKB(geometry), 'EPSG:4326', 'EPSG:3857'),
-                ST_Transform(ST_GeomFromText('{point_wkt}'), 'EPSG:4326', 'EPSG:3857')
-            ) AS distance
-        FROM 
-            read_parquet('{href}')
-        WHERE
-            bbox.xmin <= {maxx} AND
-            bbox.ymin <= {maxy} AND
-            bbox.xmax >= {minx} AND
-            bbox.ymax >= {miny}
-        ORDER BY 
-            distance
-        LIMIT 1;
+    def acquire_tile_table(self, href: str) -> str | None:
+        """
+        Returns the indexed table that holds the quadtile at href. If the tile isn't
+        cached yet, it's built in the background and None is returned. The table is
+        kept until it's released with release_tile_table.
         """
+        with self._tile_lock:
+            table = self._tile_tables.get(href)
+            if table is not None:
+                self._tile_tables.move_to_end(href)
+                self._tile_refs[table] += 1
+                return table
+            # NOTE: tiles that failed to build, e.g. on the memory limit, keep using the
+            # remote query until the retry time, instead of downloading on every click.
+            retry_at = self._tile_failures.get(href)
+            if retry_at is not None and time.monotonic() < retry_at:
+                return None
+            if href not in self._tile_builds:
+                self._tile_builds.add(href)
+                self._tile_executor.submit(self._build_tile_table, href)
+        return None
+
+    def _build_tile_table(self, href: str) -> None:
+        """Reads the quadtile at href into an indexed table and registers it."""
+        table = f"tile_{self._tile_prefix}_{next(self._tile_ids)}"
+        try:
+            with self.con.cursor() as cursor:
+                cursor.execute(
+                    self.TILE_TABLE_QUERY.format(table=table), {"href": href}
+                )
+                cursor.execute(
+                    f"CREATE INDEX {table}_rtree ON {table} USING RTREE (geometry);"
+                )
+        except Exception:
+            # The href holds the SAS token, so only log the path
+            logger.warning("Failed to cache quadtile %s", href.partition("?")[0])
+            with self._tile_lock:
+                self._tile_builds.discard(href)
+                self._tile_failures[href] = time.monotonic() + self.TILE_RETRY_AFTER
+            # The table exists when only the index failed
+            self.con.execute(f"DROP TABLE IF EXISTS {table};")
+            return
+
+        with self._tile_lock:
+            self._tile_builds.discard(href)
+            self._tile_failures.pop(href, None)
+            self._tile_tables[href] = table
+            # NOTE: hold a reference while evicting, so that the new table isn't
+            # dropped right away when the older tables are all in use.
+            self._tile_refs[table] = 1
+            evicted = self._evict_tile_tables(self.max_cached_tiles)
+            self._tile_refs[table] = 0
+        for evicted_table in evicted:
+            self.con.execute(f"DROP TABLE IF EXISTS {evicted_table};")
+
+    def get_bbox_columns(self, href: str, con) -> tuple[str, str, str, str]:
+        """Returns the bbox column expressions of the quadtile at href."""
+        columns = self._bbox_columns.get(href)
+        if columns is None:
+            names = {
+                row[0]
+                for row in con.execute(
+                    "SELECT name FROM parquet_schema($href);", {"href": href}
+                ).fetchall()
+            }
+            flat = ("bbox_xmin", "bbox_ymin", "bbox_xmax", "bbox_ymax")
+            if names.issuperset(flat):
+                columns = flat
+            else:
+                columns = ("bbox.xmin", "bbox.ymin", "bbox.xmax", "bbox.ymax")
+            self._bbox_columns[href] = columns
+        return columns
+
+    def release_tile_table(self, table: str) -> None:
+        """Releases a table from acquire_tile_table, so that it can be evicted."""
+        with self._tile_lock:
+            self._tile_refs[table] -= 1
+            evicted = self._evict_tile_tables(self.max_cached_tiles)
+        for evicted_table in evicted:
+            self.con.execute(f"DROP TABLE IF EXISTS {evicted_table};")
+
+    def _evict_tile_tables(self, max_tables: int) -> list[str]:
+        """Unregisters the least recently used tables that are not in use."""
+        # NOTE: must be called with the tile lock held; tables that are in use are
+        # skipped, so the cache can temporarily hold more than max_tables.
+        evicted = []
+        for href, table in list(self._tile_tables.items()):
+            if len(self._tile_tables) <= max_tables:
+                break
+            if self._tile_refs[table] == 0:
+                del self._tile_tables[href]
+                del self._tile_refs[table]
+                evicted.append(table)
+        return evicted
+
+    def drop_tile_tables(self):
+        """Drops the cached quadtile tables that are not in use from the connection."""
+        with self._tile_lock:
+            evicted = self._evict_tile_tables(0)
+        for table in evicted:
+            self.con.execute(f"DROP TABLE IF EXISTS {table};")
+
+    def get_nearest_geometry(self, x: float, y: float) -> dict:
+        """Returns the record of the transect nearest to (x, y), in EPSG:4326."""
+        # NOTE: 5 decimals is ~1 m, so repeated clicks on the same spot share an entry
+        key = (round(x, 5), round(y, 5))
+        with self._lock:
+            transect = self._nearest_cache.get(key)
+            if transect is not None:
+                self._nearest_cache.move_to_end(key)
+                return transect.copy()
+
+        # Query outside of the lock, so that clicks from other sessions can overlap
+        transect = self._query_nearest_geometry(x, y)
+        with self._lock:
+            self._nearest_cache[key] = transect
+            if len(self._nearest_cache) > self.cache_size:
+                self._nearest_cache.popitem(last=False)
+        return transect.copy()
+
+    def _query_nearest_geometry(self, x, y):
+        minx, miny, maxx, maxy = self._quadtile_bounds
+        idx = np.flatnonzero((minx <= x) & (x <= maxx) & (miny <= y) & (y <= maxy))
+        if idx.size == 0:
+            raise ValueError(f"No quadtile found for point ({x}, {y}).")
+        if idx.size > 1:
+            # Tiles that don't fill their bounds can overlap, so test the few hits
+            # against the prepared polygons; points on a shared edge keep the first.
+            inside = shapely.contains_xy(self._quadtile_geoms[idx], x, y)
+            if inside.any():
+                idx = idx[inside]
+        href = self._quadtile_hrefs[idx[0]]
+        px, py = self._to_proj.transform(x, y)
+
+        # Search window of self.radius meters around the point, in the data CRS
+        point_3857 = Point(get_transformer(4326, 3857).transform(x, y))
+        minx, miny, maxx, maxy = get_transformer(3857, self.proj_epsg).transform_bounds(
+            point_3857.x - self.radius,
+            point_3857.y - self.radius,
+            point_3857.x + self.radius,
+            point_3857.y + self.radius,
+        )
 
-        transect = self.con.execute(query).fetchdf()
-        transect["geometry"] = transect.geometry.map(lambda b: loads(bytes(b)))
-        return gpd.GeoDataFrame(transect, crs=self.proj_epsg)
+        # NOTE: the candidates stay in Arrow, which also returns the WKB as bytes (fetchdf
+        # returns bytearray, which shapely.from_wkb rejects), so only the nearest
+        # transect is ever converted into Python objects.
+        params = {"x": px, "y": py, "num_candidates": self.num_candidates}
+        with self.con.cursor() as cursor:
+            table = self.acquire_tile_table(href)
+            if table is None:
+                xmin, ymin, xmax, ymax = self.get_bbox_columns(href, cursor)
+                query = self.REMOTE_NEAREST_QUERY.format(
+                    xmin=xmin, ymin=ymin, xmax=xmax, ymax=ymax
+                )
+                params.update(href=href, minx=minx, miny=miny, maxx=maxx, maxy=maxy)
+                candidates = cursor.execute(query, params).to_arrow_table()
+            else:
+                try:
+                    query = self.NEAREST_QUERY.format(
+                        table=table, minx=minx, miny=miny, maxx=maxx, maxy=maxy
+                    )
+                    candidates = cursor.execute(query, params).to_arrow_table()
+                finally:
+                    self.release_tile_table(table)
+        geometries = shapely.from_wkb(
+            candidates["geometry"].to_numpy(zero_copy_only=False)
+        )
+
+        # Exact distance in EPSG:3857 for the candidates only
+        distances = shapely.distance(
+            transform_geometry(geometries, self.proj_epsg, 3857), point_3857
+        )
+        nearest = distances.argmin()
+        geometry = geometries[nearest]
+        if self.proj_epsg != 4326:
+            geometry = transform_geometry(geometry, self.proj_epsg, 4326)
+
+        # NOTE: a plain record is returned, the caller decides how to wrap it
+        transect = candidates.slice(nearest, 1).to_pylist()[0]
+        transect.update(geometry=geometry, distance=float(distances[nearest]))
+        return transect
 
 
 class SpatialQueryApp(param.Parameterized):
@@ -164,6 +529,7 @@ class SpatialQueryApp(param.Parameterized):
     MIN_HEIGHT = 450
     MAX_WIDTH = 1200
     MAX_HEIGHT = 675
+    VIEW_CACHE_SIZE = 256
 
     transect_name = param.String(
         default=None, doc="Identifier for the selected transect"
@@ -184,9 +550,18 @@ class SpatialQueryApp(param.Parameterized):
             height=self.MAX_HEIGHT,
         )
         self.transect_view = None
+        self._view_cache = OrderedDict()
+        # Number of the latest click, so that results of older clicks are dropped
+        self._click_id = 0
         self.setup_ui()
 
     def setup_ui(self):
+        # The default view is also the fallback view, so only build it once
+        self._default_view = self.visualization_func(self.default_geometry)
+
+        # Stream that pushes the selected transect into the dynamic visualization
+        self.transect_stream = streams.Pipe(data=self.default_geometry)
+
         # Setup the dynamic visualization initially
         self.transect_view = self.initialize_view()
 
@@ -198,32 +573,66 @@ class SpatialQueryApp(param.Parameterized):
         self.point_draw_stream.add_subscriber(self.on_point_draw)
 
     def initialize_view(self):
-        # Return a HoloViews pane for dynamic updates
-        return pn.pane.HoloViews(
-            self.visualization_func(self.default_geometry)
-            * self.tiles
-            * self.point_draw
+        # NOTE: only the transect overlay is dynamic. The tiles and point draw layers are
+        # created once, so new transects patch the existing Bokeh glyphs instead of
+        # re-rendering the whole overlay.
+        transect_dmap = hv.DynamicMap(
+            self.render_transect, streams=[self.transect_stream]
         )
+        # Return a HoloViews pane for dynamic updates
+        return pn.pane.HoloViews(transect_dmap * self.tiles * self.point_draw)
 
-    def on_point_draw(self, data):
-        if data:
-            x, y = data["Longitude"][0], data["Latitude"][0]
-            self.update_view(x, y)
+    def render_transect(self, data):
+        if data is self.default_geometry:
+            return self._default_view
+
+        # Reuse the views of recently selected transects
+        key = data["tr_name"]
+        view = self._view_cache.get(key)
+        if view is not None:
+            self._view_cache.move_to_end(key)
+            return view
 
-    def update_view(self, x, y):
         try:
-            geometry = self.spatial_engine.get_nearest_geometry(x, y)
-            new_view = self.visualization_func(geometry)
+            view = self.visualization_func(data)
         except Exception as e:
             logger.exception(
                 f"Visualization failed due to {e}. Reverting to default geometry."
             )
+            return self._default_view
+
+        self._view_cache[key] = view
+        if len(self._view_cache) > self.VIEW_CACHE_SIZE:
+            self._view_cache.popitem(last=False)
+        return view
+
+    def on_point_draw(self, data):
+        if data:
+            x, y = data["Longitude"][0], data["Latitude"][0]
+            self._click_id += 1
+            # Schedule the update on the event loop instead of blocking this callback
+            pn.state.execute(partial(self.update_view, x, y, self._click_id))
+
+    async def update_view(self, x, y, click_id):
+        try:
+            # NOTE: the query can take seconds, so run it in a worker thread to keep the
+            # server responsive for other callbacks and sessions in the meantime.
+            geometry = await asyncio.to_thread(
+                self.spatial_engine.get_nearest_geometry, x, y
+            )
+        except Exception as e:
+            logger.exception(f"Query failed due to {e}. Reverting to default geometry.")
             # NOTE: leave here for debugging purposes
             # logger.error(f"env: {os.environ}")
-            new_view = self.visualization_func(self.default_geometry)
+            geometry = self.default_geometry
+
+        # NOTE: queries finish in any order, e.g. a click in a cached tile overtakes one
+        # in a cold tile, so only draw the result of the latest click.
+        if click_id != self._click_id:
+            return
 
-        # Update the transect_view HoloViews pane object directly without recreating the pane
-        self.transect_view.object = new_view * self.tiles * self.point_draw
+        # Send the new transect through the stream instead of replacing the pane object
+        self.transect_stream.send(geometry)
 
     def view(self):
         # Return the transect_view pane for rendering in the app
@@ -231,21 +640,23 @@ class SpatialQueryApp(param.Parameterized):
 
 
 def default_visualization(transect):
-    polygon = gpd.GeoDataFrame(
-        geometry=[
-            create_offset_rectangle(
-                transect.to_crs(transect.estimate_utm_crs()).geometry.item(),
-                distance=200,
-            )
-        ],
-        crs=transect.estimate_utm_crs(),
+    line = transect["geometry"]
+
+    # NOTE: GCTS transects carry their UTM zone, so only estimate it when it's missing
+    utm_crs = transect.get("utm_crs")
+    if utm_crs is None:
+        utm_crs = gpd.GeoSeries([line], crs=4326).estimate_utm_crs().to_epsg()
+
+    line_utm = transform_geometry(line, 4326, int(utm_crs))
+    polygon = transform_geometry(
+        create_offset_rectangle(line_utm, distance=200), int(utm_crs), 4326
     )
 
-    polygon_plot = gv.Polygons(polygon[["geometry"]].to_crs(4326)).opts(
+    polygon_plot = gv.Polygons(gpd.GeoDataFrame(geometry=[polygon], crs=4326)).opts(
         fill_alpha=0.1, fill_color="green", line_width=2
     )
 
-    transect_plot = gv.Path(transect[["geometry"]].to_crs(4326)).opts(
+    transect_plot = gv.Path(gpd.GeoDataFrame(geometry=[line], crs=4326)).opts(
         color="red", line_width=1, tools=["hover"], active_tools=["wheel_zoom"]
     )
 
@@ -254,16 +665,16 @@ def default_visualization(transect):
 
 def prepare_default_geometry(data, crs):
     """
-    Prepares a default geometry from a data dictionary and sets its CRS This should
-    exactly match what is being returned from the spatial engine.
+    Prepares a default transect record from a data dictionary, with its geometry in
+    EPSG:4326. This should exactly match what is being returned from the spatial engine.
     """
-    geom = wkt.loads(data["geometry"])
-    gdf = gpd.GeoDataFrame([data], geometry=[geom], crs=pyproj.CRS.from_user_input(crs))
-    return gdf
-
+    geom = data["geometry"]
+    if not isinstance(geom, BaseGeometry):
+        geom = wkt.loads(geom)
+    if pyproj.CRS.from_user_input(crs).to_epsg() != 4326:
+        geom = transform_geometry(geom, crs, 4326)
+    return {**data, "geometry": geom}
 
-pn.extension()
-hv.extension("bokeh")
 
 stac_href = "https://coclico.blob.core.windows.net/stac/v1/catalog.json"
 
@@ -275,7 +686,12 @@ default_geometry = {
     "bearing": 313.57275390625,
     "utm_crs": 32631,
     "coastline_name": 33475,
-    "geometry": "LINESTRING (4.28855455531973 52.10728388554343, 4.267753743098557 52.119904391779215)",
+    "geometry": LineString(
+        [
+            (4.28855455531973, 52.10728388554343),
+            (4.267753743098557, 52.119904391779215),
+        ]
+    ),
     "bbox": {
         "xmax": 4.28855455531973,
         "ymax": 52.119904391779215,
@@ -291,10 +707,28 @@ default_geometry = {
 }
 
 
-default_geometry = prepare_default_geometry(default_geometry, crs=4326).to_crs(4326)
+def main():
+    # NOTE: the extensions are only loaded when the app is served, not on import
+    pn.extension()
+    hv.extension("bokeh")
 
-spatial_engine = SpatialQueryEngine(
-    stac_href, collection_id="gcts", storage_backend="azure"
-)
-app = SpatialQueryApp(spatial_engine, default_visualization, default_geometry)
-pn.Column(app.view()).servable()
+    # NOTE: panel serve runs this module for every session, so share the engine (and
+    # with it the quadtile index and DuckDB connection) across sessions.
+    spatial_engine = pn.state.as_cached(
+        "spatial_engine",
+        SpatialQueryEngine,
+        stac_url=stac_href,
+        collection_id="gcts",
+        storage_backend="azure",
+    )
+    app = SpatialQueryApp(
+        spatial_engine,
+        default_visualization,
+        prepare_default_geometry(default_geometry, crs=4326),
+    )
+    return pn.Column(app.view()).servable()
+
+
+# NOTE: panel serve executes this script under a bokeh_app_* module name
+if __name__.startswith("bokeh"):
+    main()
@@ -1,6 +1,15 @@
-import fsspec
+import functools
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urljoin
+
+import duckdb
 import geopandas as gpd
+import numpy as np
+import pyproj
+import shapely
 from shapely.geometry import LineString, Polygon, box
+from shapely.geometry.base import BaseGeometry
 
 
 def extract_spatial_extents(base_path, storage_options=None):
@@ -14,6 +23,9 @@ def extract_spatial_extents(base_path, storage_options=None):
     Returns:
     - DataFrame with columns ['href', 'geometry'] where 'geometry' is the spatial extent.
     """
+    # NOTE: fsspec is only needed for this offline helper, so don't import it with the app
+    import fsspec
+
     fs = fsspec.filesystem(
         "file" if "://" not in base_path else base_path.split("://")[0],
         **(storage_options or {}),
@@ -85,3 +97,237 @@ def create_offset_rectangle(line: LineString, distance: float) -> Polygon:
     polygon = Polygon([left_start, left_end, right_end, right_start])
 
     return polygon
+
+
+@functools.lru_cache(maxsize=128)
+def get_transformer(crs_from, crs_to) -> pyproj.Transformer:
+    """
+    Get a cached transformer between two coordinate reference systems.
+
+    Building a transformer queries the PROJ database, which is expensive compared to
+    transforming a handful of coordinates, so transformers are reused across calls.
+
+    Args:
+        crs_from: The source CRS, in any form accepted by pyproj (e.g., 4326).
+        crs_to: The target CRS, in any form accepted by pyproj (e.g., "EPSG:3857").
+
+    Returns:
+        pyproj.Transformer: A transformer that expects coordinates in x, y order.
+    """
+    return pyproj.Transformer.from_crs(crs_from, crs_to, always_xy=True)
+
+
+def transform_geometry(
+    geometry: BaseGeometry | np.ndarray, crs_from, crs_to
+) -> BaseGeometry | np.ndarray:
+    """
+    Transform a geometry, or an array of geometries, between two coordinate systems.
+
+    Args:
+        geometry (BaseGeometry | np.ndarray): The geometry or geometries to transform.
+        crs_from: The CRS of the input geometry.
+        crs_to: The CRS of the output geometry.
+
+    Returns:
+        BaseGeometry | np.ndarray: The geometry or geometries in the target CRS.
+    """
+    transformer = get_transformer(crs_from, crs_to)
+    return shapely.transform(geometry, transformer.transform, interleaved=False)
+
+
+@functools.cache
+def get_duckdb_connection(storage_backend: str) -> duckdb.DuckDBPyConnection:
+    """
+    Get the process-wide in-memory DuckDB connection for a storage backend.
+
+    The connection is created once and shared, so extensions, settings and caches are
+    not rebuilt for every query engine (or every Panel session). Each backend gets its
+    own named in-memory database. Settings such as threads and memory_limit are set on
+    this shared connection, so they apply to every engine that uses the same backend.
+
+    Args:
+        storage_backend (str): The storage backend the connection reads from.
+
+    Returns:
+        duckdb.DuckDBPyConnection: The shared connection.
+    """
+    return duckdb.connect(database=f":memory:{storage_backend}", read_only=False)
+
+
+def load_duckdb_extension(con: duckdb.DuckDBPyConnection, name: str) -> None:
+    """
+    Install and load a DuckDB extension, unless that was done already.
+
+    Args:
+        con (duckdb.DuckDBPyConnection): The connection to load the extension into.
+        name (str): The name of the extension (e.g., "spatial").
+    """
+    installed, loaded = con.execute(
+        "SELECT installed, loaded FROM duckdb_extensions() WHERE extension_name = ?",
+        [name],
+    ).fetchone() or (False, False)
+    if not installed:
+        con.execute(f"INSTALL {name};")
+    if not loaded:
+        con.execute(f"LOAD {name};")
+
+
+@functools.cache
+def open_stac_client(stac_url: str):
+    """
+    Open a STAC client once per catalog URL and reuse it afterwards.
+
+    Args:
+        stac_url (str): URL to the STAC catalog.
+
+    Returns:
+        pystac_client.Client: The STAC client.
+    """
+    # NOTE: imported here because the client is only needed to (re)build the index
+    import pystac_client
+
+    return pystac_client.Client.open(stac_url)
+
+
+def read_stac_items(href: str, max_workers: int = 16) -> list[dict]:
+    """
+    Read all STAC items below a static catalog or collection over a pooled session.
+
+    Static catalogs have no search endpoint, so every child catalog and item is a
+    separate request. The tree is walked level by level, and the documents of each
+    level are fetched concurrently.
+
+    Args:
+        href (str): Absolute href of the catalog or collection to start from.
+        max_workers (int): Number of concurrent requests. Defaults to 16.
+
+    Returns:
+        list[dict]: The item dictionaries, including those in nested sub-catalogs.
+    """
+    # NOTE: imported here because the client is only needed to (re)build the index
+    from pystac_client.stac_api_io import StacApiIO
+    from requests.adapters import HTTPAdapter
+
+    stac_io = StacApiIO()
+    adapter = HTTPAdapter(
+        pool_connections=max_workers, pool_maxsize=max_workers, max_retries=5
+    )
+    stac_io.session.mount("http://", adapter)
+    stac_io.session.mount("https://", adapter)
+
+    items = []
+    hrefs = [href]
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while hrefs:
+            documents = executor.map(stac_io.read_json, hrefs)
+            next_hrefs = []
+            for base_href, document in zip(hrefs, documents, strict=True):
+                if document.get("type") == "Feature":
+                    items.append(document)
+                    continue
+                # Links are usually relative to the document they're in
+                next_hrefs.extend(
+                    urljoin(base_href, link["href"])
+                    for link in document.get("links", [])
+                    if link["rel"] in ("child", "item")
+                )
+            hrefs = next_hrefs
+    return items
+
+
+def rewrite_partition(
+    src: str,
+    dst: str,
+    row_group_size: int = 10_000,
+    con: duckdb.DuckDBPyConnection | None = None,
+) -> None:
+    """
+    Rewrite a GeoParquet partition so that readers can prune row groups on the bbox.
+
+    The bbox struct is flattened into top-level bbox_xmin, bbox_ymin, bbox_xmax and
+    bbox_ymax columns, whose parquet min/max statistics allow row groups outside of
+    a query window to be skipped. The rows are sorted along a Hilbert curve over the
+    bbox centers, so that neighbouring transects end up in the same row groups, which
+    keeps those statistics tight. The pages are compressed with ZSTD. The original
+    columns (incl. the bbox struct) and GeoParquet metadata are preserved.
+
+    Args:
+        src (str): Path or URL of the partition to read.
+        dst (str): Path of the rewritten partition.
+        row_group_size (int): Number of rows per row group. Defaults to 10,000.
+        con (duckdb.DuckDBPyConnection, optional): Connection used for the rewrite,
+            e.g., with credentials for remote storage. Defaults to a new connection.
+    """
+    con = con or duckdb.connect()
+    load_duckdb_extension(con, "spatial")
+    # NOTE: keep the geometry as a WKB blob, so that the writer doesn't add its own
+    # GeoParquet metadata next to the original, which is copied below.
+    con.execute("SET enable_geoparquet_conversion = false;")
+
+    # NOTE: ST_Hilbert maps the centers onto a curve over the extent of the partition
+    xmin, ymin, xmax, ymax = con.execute(
+        "SELECT min(bbox.xmin), min(bbox.ymin), max(bbox.xmax), max(bbox.ymax) "
+        "FROM read_parquet($src)",
+        {"src": src},
+    ).fetchone()
+
+    geo_metadata = con.execute(
+        "SELECT value FROM parquet_kv_metadata($src) WHERE key = 'geo'", {"src": src}
+    ).fetchone()
+    params = {"src": src, "dst": dst}
+    kv_metadata = ""
+    if geo_metadata is not None:
+        params["geo"] = geo_metadata[0].decode()
+        kv_metadata = ", KV_METADATA {geo: $geo}"
+
+    con.execute(
+        f"""
+        COPY (
+            SELECT
+                *,
+                bbox.xmin AS bbox_xmin,
+                bbox.ymin AS bbox_ymin,
+                bbox.xmax AS bbox_xmax,
+                bbox.ymax AS bbox_ymax
+            FROM
+                read_parquet($src)
+            ORDER BY
+                ST_Hilbert(
+                    (bbox.xmin + bbox.xmax) / 2,
+                    (bbox.ymin + bbox.ymax) / 2,
+                    {{
+                        'min_x': {xmin!r},
+                        'min_y': {ymin!r},
+                        'max_x': {xmax!r},
+                        'max_y': {ymax!r}
+                    }}::BOX_2D
+                )
+        ) TO $dst (
+            FORMAT PARQUET,
+            COMPRESSION ZSTD,
+            ROW_GROUP_SIZE {row_group_size}{kv_metadata}
+        );
+        """,
+        params,
+    )
+
+
+def get_etag(url: str) -> str | None:
+    """
+    Get the ETag of a remote resource with a HEAD request.
+
+    Args:
+        url (str): URL of the resource.
+
+    Returns:
+        str | None: The ETag, or None for local paths, unreachable resources, or
+            servers that don't provide one.
+    """
+    if not url.startswith(("http://", "https://")):
+        return None
+    request = urllib.request.Request(url, method="HEAD")
+    try:
+        with urllib.request.urlopen(request, timeout=10) as response:
+            return response.headers.get("ETag")
+    except OSError:
+        return None